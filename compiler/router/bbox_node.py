@@ -115,3 +115,32 @@ class bbox_node:
         # Update the current bbox
         self.bbox = self.left.bbox.merge(self.right.bbox)
         self.is_leaf = False
+
+
+def build_bbox_tree(shapes):
+    """
+    Build a balanced bbox tree from the given shapes at once. This is much
+    faster than inserting the shapes one by one since the tree is partitioned
+    by sorting instead of comparing the merge costs for each insertion.
+    """
+
+    if not shapes:
+        return None
+    return bulk_load([bbox_node(bbox(shape)) for shape in shapes])
+
+
+def bulk_load(nodes):
+    """ Recursively split the leaf nodes in half along their longer axis. """
+
+    if len(nodes) == 1:
+        return nodes[0]
+    # Find the axis where the leaf nodes are spread the most
+    width = max(x.bbox.rect[1].x for x in nodes) - min(x.bbox.rect[0].x for x in nodes)
+    height = max(x.bbox.rect[1].y for x in nodes) - min(x.bbox.rect[0].y for x in nodes)
+    axis = 0 if width >= height else 1
+    # Sort the leaf nodes by their centers and split them in half
+    nodes = sorted(nodes, key=lambda x: x.bbox.rect[0][axis] + x.bbox.rect[1][axis])
+    half = len(nodes) // 2
+    left = bulk_load(nodes[:half])
+    right = bulk_load(nodes[half:])
+    return bbox_node(left.bbox.merge(right.bbox), left=left, right=right)
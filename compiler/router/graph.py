@@ -4,15 +4,15 @@
 # All rights reserved.
 #
 import heapq
-from copy import deepcopy
+from bisect import bisect_left, bisect_right
+import numpy as np
+from copy import copy
 from openram import debug
 from openram.base.vector import vector
 from openram.base.vector3d import vector3d
 from openram.tech import drc
-from .bbox import bbox
-from .bbox_node import bbox_node
+from .bbox_node import build_bbox_tree
 from .graph_node import graph_node
-from .graph_probe import graph_probe
 from .graph_utils import snap
 
 
@@ -33,17 +33,6 @@ class graph:
         return shape.name == self.source.name
 
 
-    def inside_shape(self, point, shape):
-        """ Return if the point is inside the shape. """
-
-        # Check if they're on the same layer
-        if point.z != self.router.get_zindex(shape.lpp):
-            return False
-        # Check if the point is inside the shape
-        ll, ur = shape.rect
-        return shape.on_segment(ll, point, ur)
-
-
     def get_safe_pin_values(self, pin):
         """ Get the safe x and y values of the given pin. """
 
@@ -72,54 +61,67 @@ class graph:
         return x_values, y_values
 
 
-    def is_probe_blocked(self, p1, p2):
+    def find_blocked_probes(self, probes):
         """
-        Return if a probe sent from p1 to p2 encounters a blockage.
-        The probe must be sent vertically or horizontally.
-        This function assumes that p1 and p2 are on the same layer.
+        Return a boolean array of whether each probe sent between a pair of
+        nodes encounters a blockage. Probes must be sent vertically or
+        horizontally, and both nodes of a probe must be on the same layer.
+        All probes are checked at once using NumPy arrays.
         """
 
-        probe_shape = graph_probe(p1, p2, self.router.get_lpp(p1.z))
-        pll, pur = probe_shape.rect
-        # Check if any blockage blocks this probe
-        for blockage in self.blockage_bbox_tree.iterate_shape(probe_shape):
-            bll, bur = blockage.rect
-            # Not on the same layer
-            if not blockage.same_lpp(blockage.lpp, probe_shape.lpp):
+        blocked = np.zeros(len(probes), dtype=bool)
+        if not probes:
+            return blocked
+        p1 = np.array([(a.center.x, a.center.y) for a, _ in probes])
+        p2 = np.array([(b.center.x, b.center.y) for _, b in probes])
+        z = np.array([a.center.z for a, _ in probes])
+        pll = np.minimum(p1, p2)
+        pur = np.maximum(p1, p2)
+        # Probes are checked only against the blockages on their own layer
+        for layer, (blockage_rects, routable_blockages, core_rects) in enumerate(self.blockage_layers):
+            bll, bur = blockage_rects
+            cll, cur = core_rects
+            indices = np.nonzero(z == layer)[0]
+            if not len(bll) or not len(indices):
                 continue
-            # Probe is blocked if the shape isn't routable
-            if not self.is_routable(blockage):
-                return True
-            blockage = blockage.get_core()
-            bll, bur = blockage.rect
-            # Not overlapping
-            if bll.x > pur.x or pll.x > bur.x or bll.y > pur.y or pll.y > bur.y:
-                return True
-        return False
+            # Check the probes in chunks to limit the size of the
+            # probe-blockage matrices
+            chunk = max(1, (1 << 20) // len(bll))
+            for i in range(0, len(indices), chunk):
+                ids = indices[i:i + chunk]
+                plx = pll[ids, 0, None]
+                ply = pll[ids, 1, None]
+                pux = pur[ids, 0, None]
+                puy = pur[ids, 1, None]
+                # Probes overlapping a blockage are blocked
+                hits = (bll[:, 0] <= pux) & (plx <= bur[:, 0]) & \
+                       (bll[:, 1] <= puy) & (ply <= bur[:, 1])
+                # Probes overlapping a routable shape are blocked only if they
+                # don't overlap its core
+                misses = (cll[:, 0] > pux) | (plx > cur[:, 0]) | \
+                         (cll[:, 1] > puy) | (ply > cur[:, 1])
+                hits[:, routable_blockages] &= misses
+                blocked[ids] = hits.any(axis=1)
+        return blocked
 
 
-    def is_node_blocked(self, node):
-        """ Return if a node is blocked by a blockage. """
+    def is_node_blocked(self, node, blockages):
+        """ Return if a node is blocked by any of the given blockages. """
 
         p = node.center
         x = p.x
         y = p.y
-        z = p.z
 
         def closest(value, checklist):
             """ Return the distance of the closest value in the checklist. """
             diffs = [abs(value - other) for other in checklist]
             return snap(min(diffs))
 
-        wide = self.router.track_wire
-        half_wide = self.router.half_wire
-        spacing = snap(self.router.track_space + half_wide + drc["grid"])
+        wide = self.wide
+        half_wide = self.half_wide
+        spacing = self.safe_spacing
         blocked = False
-        for blockage in self.blockage_bbox_tree.iterate_point(p):
-            ll, ur = blockage.rect
-            # Not on the same layer
-            if self.router.get_zindex(blockage.lpp) != z:
-                continue
+        for blockage in blockages:
             # Blocked if not routable
             if not self.is_routable(blockage):
                 blocked = True
@@ -131,9 +133,7 @@ class graph:
                 blocked = True
                 continue
             # Check if the node is too close to one edge of the shape
-            lengths = [blockage.width(), blockage.height()]
-            centers = blockage.center()
-            ll, ur = blockage.rect
+            lengths, centers, xs, ys = self.routable_values[blockage]
             safe = [True, True]
             for i in range(2):
                 if lengths[i] >= wide:
@@ -146,7 +146,6 @@ class graph:
                 blocked = True
                 continue
             # Check if the node is in a safe region of the shape
-            xs, ys = self.get_safe_pin_values(blockage)
             xdiff = closest(p.x, xs)
             ydiff = closest(p.y, ys)
             if xdiff == 0 and ydiff == 0:
@@ -160,20 +159,15 @@ class graph:
     def is_via_blocked(self, nodes):
         """ Return if a via on the given point is blocked by another via. """
 
-        # If the nodes are blocked by a blockage other than a via
-        for node in nodes:
-            if self.is_node_blocked(node):
-                return True
-
         # Skip if no via is present
         if len(self.graph_vias) == 0:
             return False
 
         # If the nodes are blocked by a via
-        x = node.center.x
-        y = node.center.y
-        z = node.center.z
-        for via in self.via_bbox_tree.iterate_point(node.center):
+        point = nodes[0].center
+        x = point.x
+        y = point.y
+        for via in self.via_bbox_tree.iterate_point(point):
             ll, ur = via.rect
             # Not overlapping
             if ll.x > x or x > ur.x or ll.y > y or y > ur.y:
@@ -194,7 +188,9 @@ class graph:
         self.target = target
 
         # Find the region to be routed and only include objects inside that region
-        region = deepcopy(source)
+        # NOTE: A shallow copy is enough since `bbox` replaces the rect instead
+        # of modifying it
+        region = copy(source)
         region.bbox([target])
         region = region.inflated_pin(spacing=self.router.track_width + self.router.track_space)
         debug.info(4, "Routing region is {}".format(region.rect))
@@ -213,12 +209,17 @@ class graph:
         region.bbox(self.graph_blockages)
         # Find and include edge shapes to prevent DRC errors
         self.find_graph_blockages(region)
-        # Build the bbox tree
-        self.build_bbox_trees()
-        # Generate the graph nodes from cartesian values
+        # Build the bbox tree for vias
+        self.build_via_bbox_tree()
+        # Save the blockage bounding boxes to check probes faster
+        self.build_blockage_arrays()
+        # Save the values of routable shapes to check nodes faster
+        self.save_routable_values()
+        # Save the spacing values to check nodes faster
+        self.save_spacing_values()
+        # Generate the graph nodes from cartesian values and save the ones
+        # that lie in source and target shapes
         self.generate_graph_nodes(x_values, y_values)
-        # Save the graph nodes that lie in source and target shapes
-        self.save_end_nodes()
         debug.info(4, "Number of blockages detected in the routing region: {}".format(len(self.graph_blockages)))
         debug.info(4, "Number of vias detected in the routing region: {}".format(len(self.graph_vias)))
         debug.info(4, "Number of nodes in the routing graph: {}".format(len(self.nodes)))
@@ -227,15 +228,18 @@ class graph:
     def find_graph_blockages(self, region):
         """ Find blockages that overlap the routing region. """
 
+        # NOTE: The region covers both layers, so only the bounding boxes are
+        # compared
+        rll, rur = region.rect
+        included = set(self.graph_blockages)
         for blockage in self.router.blockages:
             # Skip if already included
-            if blockage in self.graph_blockages:
+            if blockage in included:
                 continue
-            # Set the region's lpp to current blockage's lpp so that the
-            # overlaps method works
-            region.lpp = blockage.lpp
-            if region.overlaps(blockage):
+            ll, ur = blockage.rect
+            if ll.x <= rur.x and rll.x <= ur.x and ll.y <= rur.y and rll.y <= ur.y:
                 self.graph_blockages.append(blockage)
+                included.add(blockage)
         # Make sure that the source or target fake pins are included as blockage
         for shape in [self.source, self.target]:
             for blockage in self.graph_blockages:
@@ -249,30 +253,76 @@ class graph:
     def find_graph_vias(self, region):
         """ Find vias that overlap the routing region. """
 
+        # NOTE: The region covers both layers, so only the bounding boxes are
+        # compared
+        rll, rur = region.rect
+        included = set(self.graph_vias)
         for via in self.router.vias:
             # Skip if already included
-            if via in self.graph_vias:
+            if via in included:
                 continue
-            # Set the regions's lpp to current via's lpp so that the
-            # overlaps method works
-            region.lpp = via.lpp
-            if region.overlaps(via):
+            ll, ur = via.rect
+            if ll.x <= rur.x and rll.x <= ur.x and ll.y <= rur.y and rll.y <= ur.y:
                 self.graph_vias.append(via)
+                included.add(via)
 
 
-    def build_bbox_trees(self):
-        """ Build bbox trees for blockages and vias in the routing region. """
+    def build_via_bbox_tree(self):
+        """ Build the bbox tree for vias in the routing region. """
 
-        # Bbox tree for blockages
-        self.blockage_bbox_tree = bbox_node(bbox(self.graph_blockages[0]))
-        for i in range(1, len(self.graph_blockages)):
-            self.blockage_bbox_tree.insert(bbox(self.graph_blockages[i]))
-        # Bbox tree for vias
-        if len(self.graph_vias) == 0:
-            return
-        self.via_bbox_tree = bbox_node(bbox(self.graph_vias[0]))
-        for i in range(1, len(self.graph_vias)):
-            self.via_bbox_tree.insert(bbox(self.graph_vias[i]))
+        self.via_bbox_tree = build_bbox_tree(self.graph_vias)
+
+
+    def build_blockage_arrays(self):
+        """ Save blockages in the routing region as NumPy arrays. """
+
+        def rect_array(shapes):
+            """ Return the lower left and upper right corners of shapes. """
+            rects = np.array([[(ll.x, ll.y), (ur.x, ur.y)] for ll, ur in (x.rect for x in shapes)]).reshape(-1, 2, 2)
+            return rects[:, 0], rects[:, 1]
+
+        # Blockages are split by layer so that probes are checked only against
+        # the blockages on the same layer
+        self.blockage_layers = []
+        for z in [0, 1]:
+            lpp = self.router.get_lpp(z)
+            blockages = [x for x in self.graph_blockages if x.same_lpp(x.lpp, lpp)]
+            # Only routable blockages need their cores to be checked
+            routable_blockages = [i for i, x in enumerate(blockages) if self.is_routable(x)]
+            core_rects = rect_array(blockages[i].get_core() for i in routable_blockages)
+            self.blockage_layers.append((rect_array(blockages), routable_blockages, core_rects))
+
+
+    def save_routable_values(self):
+        """
+        Save the sizes, centers, and safe pin values of routable shapes in the
+        routing region so that they aren't calculated for each node.
+        """
+
+        # NOTE: Cores are used as keys since all the saved values only depend
+        # on their rectangles
+        self.routable_values = {}
+        for blockage in self.graph_blockages:
+            if not self.is_routable(blockage):
+                continue
+            core = blockage.get_core()
+            if core in self.routable_values:
+                continue
+            lengths = [core.width(), core.height()]
+            xs, ys = self.get_safe_pin_values(core)
+            self.routable_values[core] = (lengths, core.center(), xs, ys)
+
+
+    def save_spacing_values(self):
+        """
+        Save the wire and spacing values used to check nodes so that they
+        aren't calculated for each node.
+        """
+
+        self.wide = self.router.track_wire
+        self.half_wide = self.router.half_wire
+        # Minimum distance of a node to a safe region of a routable shape
+        self.safe_spacing = snap(self.router.track_space + self.router.half_wire + drc["grid"])
 
 
     def generate_cartesian_values(self):
@@ -281,8 +331,8 @@ class graph:
         routing region.
         """
 
-        x_values = set()
-        y_values = set()
+        x_values = []
+        y_values = []
 
         # Add inner values for blockages of the routed type
         for shape in self.graph_blockages:
@@ -290,8 +340,8 @@ class graph:
                 continue
             # Get the safe pin values
             xs, ys = self.get_safe_pin_values(shape)
-            x_values.update(xs)
-            y_values.update(ys)
+            x_values.extend(xs)
+            y_values.extend(ys)
 
         # Add corners for blockages
         offset = vector([drc["grid"]] * 2)
@@ -300,20 +350,19 @@ class graph:
             # Add minimum offset to the blockage corner nodes to prevent overlap
             nll = snap(ll - offset)
             nur = snap(ur + offset)
-            x_values.update([nll.x, nur.x])
-            y_values.update([nll.y, nur.y])
+            x_values.extend([nll.x, nur.x])
+            y_values.extend([nll.y, nur.y])
 
         # Add center values for existing vias
         for via in self.graph_vias:
             p = via.center()
-            x_values.add(p.x)
-            y_values.add(p.y)
+            x_values.append(p.x)
+            y_values.append(p.y)
 
-        # Sort x and y values
-        x_values = list(x_values)
-        y_values = list(y_values)
-        x_values.sort()
-        y_values.sort()
+        # Remove duplicates and sort x and y values
+        # NOTE: All values are snapped, so duplicates are exactly equal
+        x_values = np.unique(x_values).tolist()
+        y_values = np.unique(y_values).tolist()
 
         return x_values, y_values
 
@@ -325,69 +374,103 @@ class graph:
         """
 
         # Generate all nodes
+        # NOTE: Nodes are also kept in a grid as grid[x][y][z] so that
+        # neighbors can be found without index arithmetic on the node list
         self.nodes = []
+        grid = []
         for x in x_values:
+            column = []
             for y in y_values:
-                for z in [0, 1]:
-                    self.nodes.append(graph_node([x, y, z]))
+                nodes = [graph_node([x, y, z]) for z in [0, 1]]
+                self.nodes.extend(nodes)
+                column.append(nodes)
+            grid.append(column)
 
         # Mark nodes that will be removed
-        self.mark_blocked_nodes()
-
-        # Connect closest nodes that won't be removed
-        def search(index, condition, shift):
-            """ Search and connect neighbor nodes. """
-            base_nodes = self.nodes[index:index+2]
+        self.mark_blocked_nodes(grid, x_values, y_values)
+
+        # Find closest nodes that won't be removed as edge candidates
+        # NOTE: Edges are saved in order and connected after all probes are
+        # checked so that the neighbor order of nodes doesn't change
+        edges = []
+        is_probe = []
+        def search(base_nodes, candidates):
+            """ Search neighbor nodes to be connected. """
             found = [base_nodes[0].remove,
                      base_nodes[1].remove]
-            while condition(index) and not all(found):
-                nodes = self.nodes[index - shift:index - shift + 2]
+            for nodes in candidates:
+                if all(found):
+                    break
                 for k in range(2):
                     if not found[k] and not nodes[k].remove:
                         found[k] = True
-                        if not self.is_probe_blocked(base_nodes[k].center, nodes[k].center):
-                            base_nodes[k].add_neighbor(nodes[k])
-                index -= shift
-        y_len = len(y_values)
-        for i in range(0, len(self.nodes), 2):
-            search(i, lambda count: (count / 2) % y_len, 2) # Down
-            search(i, lambda count: (count / 2) >= y_len, y_len * 2) # Left
-            if not self.nodes[i].remove and \
-               not self.nodes[i + 1].remove and \
-               not self.is_via_blocked(self.nodes[i:i+2]):
-                self.nodes[i].add_neighbor(self.nodes[i + 1])
+                        edges.append((base_nodes[k], nodes[k]))
+                        is_probe.append(True)
+        for i, column in enumerate(grid):
+            for j, nodes in enumerate(column):
+                search(nodes, (column[k] for k in range(j - 1, -1, -1))) # Down
+                search(nodes, (grid[k][j] for k in range(i - 1, -1, -1))) # Left
+                if not nodes[0].remove and \
+                   not nodes[1].remove and \
+                   not self.is_via_blocked(nodes):
+                    edges.append((nodes[0], nodes[1]))
+                    is_probe.append(False)
+
+        # Check all probes at once and connect the nodes that aren't blocked
+        probes = [edge for edge, probe in zip(edges, is_probe) if probe]
+        blocked = iter(self.find_blocked_probes(probes))
+        for (a, b), probe in zip(edges, is_probe):
+            if probe and next(blocked):
+                continue
+            a.add_neighbor(b)
 
         # Remove marked nodes
         self.remove_blocked_nodes()
 
+        # Number the remaining nodes so that they can be used as list indices,
+        # and save the ones that are inside source and target pins
+        sll, sur = self.source.rect
+        sz = self.router.get_zindex(self.source.lpp)
+        tll, tur = self.target.rect
+        tz = self.router.get_zindex(self.target.lpp)
+        for i, node in enumerate(self.nodes):
+            node.index = i
+            x = node.center.x
+            y = node.center.y
+            z = node.center.z
+            if z == sz and sll.x <= x <= sur.x and sll.y <= y <= sur.y:
+                self.source_nodes.append(node)
+            elif z == tz and tll.x <= x <= tur.x and tll.y <= y <= tur.y:
+                self.target_nodes.append(node)
 
-    def mark_blocked_nodes(self):
+
+    def mark_blocked_nodes(self, grid, x_values, y_values):
         """ Mark graph nodes to be removed that are blocked by a blockage. """
 
-        for i in range(len(self.nodes) - 1, -1, -1):
-            node = self.nodes[i]
-            if self.is_node_blocked(node):
+        # Put each blockage into the grid nodes it covers using the cartesian
+        # values so that nodes don't need to search for them
+        node_blockages = {}
+        for blockage in self.graph_blockages:
+            z = self.router.get_zindex(blockage.lpp)
+            ll, ur = blockage.rect
+            y_range = range(bisect_left(y_values, ll.y), bisect_right(y_values, ur.y))
+            for i in range(bisect_left(x_values, ll.x), bisect_right(x_values, ur.x)):
+                for j in y_range:
+                    node_blockages.setdefault(grid[i][j][z], []).append(blockage)
+
+        for node, blockages in node_blockages.items():
+            if self.is_node_blocked(node, blockages):
                 node.remove = True
 
 
     def remove_blocked_nodes(self):
         """ Remove graph nodes that are marked to be removed. """
 
-        for i in range(len(self.nodes) - 1, -1, -1):
-            node = self.nodes[i]
+        # Disconnect the marked nodes and keep the rest in a single pass
+        for node in self.nodes:
             if node.remove:
                 node.remove_all_neighbors()
-                self.nodes.remove(node)
-
-
-    def save_end_nodes(self):
-        """ Save graph nodes that are inside source and target pins. """
-
-        for node in self.nodes:
-            if self.inside_shape(node.center, self.source):
-                self.source_nodes.append(node)
-            elif self.inside_shape(node.center, self.target):
-                self.target_nodes.append(node)
+        self.nodes = [x for x in self.nodes if not x.remove]
 
 
     def find_shortest_path(self):
@@ -396,28 +479,49 @@ class graph:
         A* algorithm.
         """
 
+        # Save the target coordinates once so that the heuristic function
+        # doesn't visit the target nodes for each call
+        target_xyz = [(t.center.x, t.center.y, t.center.z) for t in self.target_nodes]
+        h_scores = [None] * len(self.nodes)
+
         # Heuristic function to calculate the scores
         def h(node):
             """ Return the estimated distance to the closest target. """
+            if h_scores[node.index] is not None:
+                return h_scores[node.index]
+            x = node.center.x
+            y = node.center.y
+            z = node.center.z
             min_dist = float("inf")
-            for t in self.target_nodes:
-                dist = t.center.distance(node.center) + abs(t.center.z - node.center.z)
+            for tx, ty, tz in target_xyz:
+                # Skip this target early if it's already farther on x-axis
+                dist = abs(tx - x)
+                if dist >= min_dist:
+                    continue
+                dist += abs(ty - y)
+                dist += abs(tz - z)
                 if dist < min_dist:
                     min_dist = dist
+            h_scores[node.index] = min_dist
             return min_dist
 
         # Initialize data structures to be used for A* search
+        # NOTE: Scores and the closed set are kept in arrays indexed by the node
+        # indices since indexing is faster than dict and set lookups
         queue = []
-        close_set = set()
-        came_from = {}
-        g_scores = {}
-        f_scores = {}
+        turn_cost = drc["grid"]
+        close_set = bytearray(len(self.nodes))
+        target_ids = {t.id for t in self.target_nodes}
+        came_from = [None] * len(self.nodes)
+        g_scores = [float("inf")] * len(self.nodes)
+        f_scores = [float("inf")] * len(self.nodes)
+        best_target_score = float("inf")
 
         # Initialize score values for the source nodes
         for node in self.source_nodes:
-            g_scores[node.id] = 0
-            f_scores[node.id] = h(node)
-            heapq.heappush(queue, (f_scores[node.id], node.id, node))
+            g_scores[node.index] = 0
+            f_scores[node.index] = h(node)
+            heapq.heappush(queue, (f_scores[node.index], node.id, node))
 
         # Run the A* algorithm
         while len(queue) > 0:
@@ -425,33 +529,46 @@ class graph:
             current = heapq.heappop(queue)[2]
 
             # Skip this node if already discovered
-            if current in close_set:
+            if close_set[current.index]:
                 continue
-            close_set.add(current)
+            close_set[current.index] = 1
 
             # Check if we've reached the target
-            if current in self.target_nodes:
+            if current.id in target_ids:
                 path = []
-                while current.id in came_from:
+                while came_from[current.index] is not None:
                     path.append(current)
-                    current = came_from[current.id]
+                    current = came_from[current.index]
                 path.append(current)
                 path.reverse()
                 return path
 
-            # Get the previous node to better calculate the next costs
-            prev_node = None
-            if current.id in came_from:
-                prev_node = came_from[current.id]
+            # Get the previous direction to better calculate the next costs
+            prev_node = came_from[current.index]
+            prev_dir = None if prev_node is None else current.get_direction(prev_node)
+            g_score = g_scores[current.index]
 
             # Update neighbor scores
-            for node in current.neighbors:
-                tentative_score = current.get_edge_cost(node, prev_node) + g_scores[current.id]
-                if node.id not in g_scores or tentative_score < g_scores[node.id]:
-                    came_from[node.id] = current
-                    g_scores[node.id] = tentative_score
-                    f_scores[node.id] = tentative_score + h(node)
-                    heapq.heappush(queue, (f_scores[node.id], node.id, node))
+            for node, cost in current.neighbors.items():
+                # Add a constant wire cost to prevent dog-legs
+                if prev_dir is not None and prev_dir != current.get_direction(node):
+                    cost += turn_cost
+                tentative_score = cost + g_score
+                if tentative_score < g_scores[node.index]:
+                    came_from[node.index] = current
+                    g_scores[node.index] = tentative_score
+                    # Don't push closed nodes since they will be skipped anyway
+                    if close_set[node.index]:
+                        continue
+                    f_scores[node.index] = tentative_score + h(node)
+                    # Save the best score of the targets found so far
+                    if node.id in target_ids and tentative_score < best_target_score:
+                        best_target_score = tentative_score
+                    # Don't push nodes that can't be popped before the best
+                    # target since the search ends when a target is popped
+                    if f_scores[node.index] > best_target_score:
+                        continue
+                    heapq.heappush(queue, (f_scores[node.index], node.id, node))
 
         # Return None if not connected
         return None
@@ -4,12 +4,14 @@
 # All rights reserved.
 #
 from openram.base.vector3d import vector3d
-from openram.tech import drc
 
 
 class graph_node:
     """ This class represents a node on the graph. """
 
+    # Graphs have many nodes, so don't create a dict for each of them
+    __slots__ = ("id", "center", "neighbors", "remove", "index")
+
     # This is used to assign unique ids to nodes
     next_id = 0
 
@@ -21,32 +23,36 @@ class graph_node:
             self.center = center
         else:
             self.center = vector3d(center)
-        self.neighbors = []
+        # Neighbors are mapped to the costs of edges to them
+        self.neighbors = {}
         self.remove = False
+        # This is the position of this node in the graph's node list
+        self.index = None
 
 
     def add_neighbor(self, other):
         """ Connect two nodes. """
 
         if other not in self.neighbors:
-            self.neighbors.append(other)
-            other.neighbors.append(self)
+            cost = self.get_base_cost(other)
+            self.neighbors[other] = cost
+            other.neighbors[self] = cost
 
 
     def remove_neighbor(self, other):
         """ Disconnect two nodes. """
 
         if other in self.neighbors:
-            self.neighbors.remove(other)
-            other.neighbors.remove(self)
+            del self.neighbors[other]
+            del other.neighbors[self]
 
 
     def remove_all_neighbors(self):
         """ Disconnect all current neighbors. """
 
         for neighbor in self.neighbors:
-            self.neighbors.remove(neighbor)
-            neighbor.neighbors.remove(self)
+            del neighbor.neighbors[self]
+        self.neighbors = {}
 
 
     def get_direction(self, b):
@@ -57,18 +63,16 @@ class graph_node:
         return (horiz, vert)
 
 
-    def get_edge_cost(self, other, prev_node=None):
-        """ Get the cost of going from this node to the other node. """
+    def get_base_cost(self, other):
+        """
+        Get the cost of going from this node to the other node without the
+        wire cost of turning.
+        """
 
-        if other in self.neighbors:
-            is_vertical = self.center.x == other.center.x
-            layer_dist = self.center.distance(other.center)
-            # Double the cost if the edge is in non-preferred direction
-            if is_vertical != bool(self.center.z):
-                layer_dist *= 4
-            # Add a constant wire cost to prevent dog-legs
-            if prev_node and self.get_direction(prev_node) != self.get_direction(other):
-                layer_dist += drc["grid"]
-            via_dist = abs(self.center.z - other.center.z) * 2
-            return layer_dist + via_dist
-        return float("inf")
+        is_vertical = self.center.x == other.center.x
+        layer_dist = self.center.distance(other.center)
+        # Double the cost if the edge is in non-preferred direction
+        if is_vertical != bool(self.center.z):
+            layer_dist *= 4
+        via_dist = abs(self.center.z - other.center.z) * 2
+        return layer_dist + via_dist